@@ -1,5 +1,10 @@
 import pyodbc
 from db_config import MSSQL_CONNECTION_STRING
+from html_pipeline import run_html_pipeline
+import latency
+from latency import (
+    DeadlineExceeded, hedged_invoke, new_deadline, stage_deadline, get_latency_stats, valid_deadline_seconds,
+)
 
 # Helper to fetch table schema
 def get_table_schema(cursor, table_name):
@@ -87,6 +92,8 @@ CORS(app, origins=['http://localhost:3000'])
 
 # Initialize Gemini LLM with explicit API key
 import os
+import json
+from html import escape
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -222,12 +229,49 @@ class CampaignState(TypedDict):
     audience_segments: List[str]
     content: List[dict]  # Will store {'segment': '...', 'copy': '...'}
     review_task: str
+    num_variants: int  # Optional: number of A/B copy variants per segment
+    deadline_at: float  # Monotonic time by which the whole request must finish
+
+def build_fallback_segments(distinct_products, distinct_locations, distinct_behaviors):
+    """Build audience segments from database values alone, without the LLM"""
+    # Create fallback segments optimized for marketing reach
+    fallback_segments = []
+    
+    # Strategic segment 1: High-value product enthusiasts
+    if distinct_products:
+        high_value_products = [p for p in distinct_products if any(keyword in p.lower() for keyword in ['laptop', 'desktop', 'monitor', 'tablet'])]
+        if high_value_products:
+            product_segment = f"Tech professionals in major cities interested in {', '.join(high_value_products[:2])}"
+        else:
+            product_segment = f"Tech enthusiasts interested in {', '.join(distinct_products[:3])}"
+        fallback_segments.append(product_segment)
+    
+    # Strategic segment 2: Geographic + behavioral targeting
+    if distinct_locations and distinct_behaviors:
+        major_cities = [loc for loc in distinct_locations if any(city in loc.lower() for city in ['new york', 'los angeles', 'chicago', 'houston', 'phoenix'])]
+        high_intent_behaviors = [b for b in distinct_behaviors if any(keyword in b.lower() for keyword in ['frequent', 'shopping', 'research', 'engagement'])]
+        
+        if major_cities and high_intent_behaviors:
+            location_segment = f"Active shoppers in {', '.join(major_cities[:2])} with {high_intent_behaviors[0].lower()}"
+        else:
+            location_segment = f"Customers in {', '.join(distinct_locations[:2])} markets"
+        fallback_segments.append(location_segment)
+    
+    # Fallback to generic high-reach segments if no data
+    if not fallback_segments:
+        fallback_segments = [
+            'Tech-savvy professionals in metropolitan areas',
+            'Price-conscious consumers with frequent online shopping behavior'
+        ]
+    
+    return fallback_segments
 
 # Define the workflow nodes (stub functions)
 def generate_audience(state: CampaignState):
     """Generate audience segments based on intent brief using Gemini LLM"""
     print('🎯 [DEBUG] Starting audience generation...')
     print(f'🎯 [DEBUG] Campaign brief: {state.get("intent_brief", "No brief provided")}')
+    audience_deadline = stage_deadline(state.get('deadline_at'), 'audience')
     
     # Connect to MSSQL and fetch schemas and lookup values
     print('🔌 [DEBUG] Attempting database connection...')
@@ -344,37 +388,7 @@ DATA INSIGHTS:
     # Check if Gemini is available
     if not audience_chain:
         print('Gemini not available, using strategic data-driven fallback response')
-        # Create fallback segments optimized for marketing reach
-        fallback_segments = []
-        
-        # Strategic segment 1: High-value product enthusiasts
-        if distinct_products:
-            high_value_products = [p for p in distinct_products if any(keyword in p.lower() for keyword in ['laptop', 'desktop', 'monitor', 'tablet'])]
-            if high_value_products:
-                product_segment = f"Tech professionals in major cities interested in {', '.join(high_value_products[:2])}"
-            else:
-                product_segment = f"Tech enthusiasts interested in {', '.join(distinct_products[:3])}"
-            fallback_segments.append(product_segment)
-        
-        # Strategic segment 2: Geographic + behavioral targeting
-        if distinct_locations and distinct_behaviors:
-            major_cities = [loc for loc in distinct_locations if any(city in loc.lower() for city in ['new york', 'los angeles', 'chicago', 'houston', 'phoenix'])]
-            high_intent_behaviors = [b for b in distinct_behaviors if any(keyword in b.lower() for keyword in ['frequent', 'shopping', 'research', 'engagement'])]
-            
-            if major_cities and high_intent_behaviors:
-                location_segment = f"Active shoppers in {', '.join(major_cities[:2])} with {high_intent_behaviors[0].lower()}"
-            else:
-                location_segment = f"Customers in {', '.join(distinct_locations[:2])} markets"
-            fallback_segments.append(location_segment)
-        
-        # Fallback to generic high-reach segments if no data
-        if not fallback_segments:
-            fallback_segments = [
-                'Tech-savvy professionals in metropolitan areas',
-                'Price-conscious consumers with frequent online shopping behavior'
-            ]
-        
-        return {'audience_segments': fallback_segments}
+        return {'audience_segments': build_fallback_segments(distinct_products, distinct_locations, distinct_behaviors)}
 
     try:
         # Get the intent brief from the state
@@ -397,7 +411,7 @@ DATA INSIGHTS:
         print(f'🤖 [DEBUG] Invoking LLM with audience chain...')
         print(f'🤖 [DEBUG] Audience chain available: {audience_chain is not None}')
         
-        generated_audience = audience_chain.invoke(prompt_input)
+        generated_audience = hedged_invoke('audience', audience_chain, prompt_input, audience_deadline)
         
         print(f'✅ [DEBUG] LLM processing completed successfully!')
         print(f'✅ [DEBUG] Generated audience type: {type(generated_audience)}')
@@ -414,6 +428,9 @@ DATA INSIGHTS:
         
         return {'audience_segments': generated_audience}
         
+    except DeadlineExceeded as e:
+        print(f'⏱️ [DEBUG] {e}, using data-driven fallback segments')
+        return {'audience_segments': build_fallback_segments(distinct_products, distinct_locations, distinct_behaviors)}
     except Exception as e:
         print(f'❌ [DEBUG] LLM processing failed!')
         print(f'❌ [DEBUG] Error type: {type(e).__name__}')
@@ -424,10 +441,216 @@ DATA INSIGHTS:
         return {'audience_segments': ['Tech-savvy professionals (LLM processing failed)', 'Price-conscious consumers (LLM processing failed)']}
 
 
+# --- Multi-variant content generation (A/B testing) ---
+MIN_VARIANTS = 2
+MAX_VARIANTS = 5
+
+# JSON schema for the structured-output call; the list is wrapped in an object
+# because Gemini function calling requires an object at the top level
+VARIANTS_SCHEMA = {
+    'title': 'ContentVariants',
+    'description': 'Distinct copy variants of the same campaign content for A/B testing',
+    'type': 'object',
+    'properties': {
+        'variants': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'subject': {'type': 'string', 'description': 'Email subject line or banner headline'},
+                    'html': {'type': 'string', 'description': 'Complete HTML with inline CSS'},
+                },
+                'required': ['subject', 'html'],
+            },
+        },
+    },
+    'required': ['variants'],
+}
+
+CHANNEL_VARIANT_INSTRUCTIONS = {
+    'email': "a responsive HTML email. All CSS must be inline, not in a separate <style> block or file. "
+             "The subject is the email subject line",
+    'banner': "a simple, visually appealing HTML digital banner with inline CSS. "
+              "The subject is the banner headline",
+}
+
+variants_prompt = ChatPromptTemplate.from_template(
+    "You are an expert marketer preparing an A/B test. Write {num_variants} distinct variants of {channel_instructions}.\n"
+    "Each variant must take a clearly different creative angle (tone, hook or call to action) while staying on brief.\n"
+    "BRIEF: {intent_brief}\nAUDIENCE SEGMENT: {audience_segment}\n"
+    "Return exactly {num_variants} variants, each with a 'subject' and an 'html' field."
+)
+
+if llm:
+    variants_chain = variants_prompt | llm.with_structured_output(VARIANTS_SCHEMA, include_raw=True)
+else:
+    variants_chain = None
+
+
+def _raw_variants_payload(raw_message):
+    """Get the unparsed structured output from the raw model message (tool call args or text)"""
+    if raw_message is None:
+        return None
+    tool_calls = getattr(raw_message, 'tool_calls', None) or []
+    if tool_calls:
+        return tool_calls[0].get('args')
+    invalid_tool_calls = getattr(raw_message, 'invalid_tool_calls', None) or []
+    if invalid_tool_calls:
+        return invalid_tool_calls[0].get('args')
+    return getattr(raw_message, 'content', raw_message)
+
+
+def _decode_json_objects(text):
+    """Decode every top-level-decodable JSON object in text, skipping malformed regions"""
+    decoder = json.JSONDecoder()
+    objects = []
+    index = text.find('{')
+    while index != -1:
+        try:
+            obj, end = decoder.raw_decode(text, index)
+            objects.append(obj)
+            index = text.find('{', end)
+        except ValueError:
+            index = text.find('{', index + 1)
+    return objects
+
+
+def parse_variants(payload, num_variants):
+    """
+    Parse the variants payload into a list of {'subject', 'html'} dicts.
+    Accepts the parsed dict, a bare list or raw JSON text. Malformed variants
+    are dropped individually so the well-formed ones are still returned.
+    Returns (variants, errors).
+    """
+    errors = []
+    if isinstance(payload, list) and payload and isinstance(payload[0], dict) and 'text' in payload[0]:
+        # Multi-part message content
+        payload = ''.join(part.get('text', '') for part in payload if isinstance(part, dict))
+    if isinstance(payload, str):
+        text = payload.strip()
+        if text.startswith('```'):
+            text = text.strip('`').split('\n', 1)[-1]
+        try:
+            payload = json.loads(text)
+        except ValueError as e:
+            errors.append(f'Response is not valid JSON ({e}), recovering individual variants')
+            recovered = _decode_json_objects(text)
+            if len(recovered) == 1 and isinstance(recovered[0].get('variants'), list):
+                payload = recovered[0]
+            else:
+                payload = [obj for obj in recovered if 'subject' in obj or 'html' in obj]
+    if isinstance(payload, dict):
+        payload = payload.get('variants', [])
+    if not isinstance(payload, list):
+        errors.append(f'Expected a list of variants, got {type(payload).__name__}')
+        return [], errors
+
+    variants = []
+    for i, candidate in enumerate(payload, 1):
+        if isinstance(candidate, str):
+            try:
+                candidate = json.loads(candidate)
+            except ValueError:
+                errors.append(f'Variant {i} is not a JSON object')
+                continue
+        if not isinstance(candidate, dict):
+            errors.append(f'Variant {i} is not an object')
+            continue
+        subject = candidate.get('subject')
+        html = candidate.get('html')
+        if not isinstance(html, str) or not html.strip():
+            errors.append(f'Variant {i} has no html')
+            continue
+        if not isinstance(subject, str) or not subject.strip():
+            errors.append(f'Variant {i} has no subject, using a placeholder')
+            subject = f'Variant {i}'
+        variants.append({'subject': subject.strip(), 'html': html})
+    if len(variants) > num_variants:
+        variants = variants[:num_variants]
+    elif len(variants) < num_variants:
+        errors.append(f'Expected {num_variants} variants, got {len(variants)}')
+    return variants, errors
+
+
+def generate_content_variants(channel, state):
+    """Generate N content variants for a segment in a single structured-output LLM call"""
+    segment = state.get('audience_segment')
+    num_variants = state['num_variants']
+    print(f"[VariantsSubAgent] Generating {num_variants} {channel} variants for: {segment}")
+    content = {'type': channel, 'segment': segment}
+    if channel == 'banner':
+        content['css'] = ''
+    if not variants_chain:
+        variants = [
+            {'subject': f'Stub {channel} variant {i}', 'html': f'<p style="color: blue;">Stub {channel} variant {i}</p>'}
+            for i in range(1, num_variants + 1)
+        ]
+        errors = []
+    else:
+        try:
+            response = hedged_invoke('variants', variants_chain, {
+                'intent_brief': state['intent_brief'],
+                'audience_segment': segment,
+                'num_variants': num_variants,
+                'channel_instructions': CHANNEL_VARIANT_INSTRUCTIONS[channel],
+            }, state.get('deadline_at'))
+            payload = response.get('parsed')
+            errors = []
+            if payload is None:
+                errors.append(f"Structured output parsing failed: {response.get('parsing_error')}")
+                payload = _raw_variants_payload(response.get('raw'))
+            variants, parse_errors = parse_variants(payload, num_variants)
+            errors.extend(parse_errors)
+        except DeadlineExceeded as e:
+            # Same policy as the single-variant subagents: only a missed deadline
+            # degrades to fallback content, other LLM errors propagate
+            print(f'⏱️ [DEBUG] {e}, using fallback variant')
+            fallback = fallback_content(channel, state)
+            variants, errors = [{'subject': fallback['subject'], 'html': fallback['html']}], [str(e)]
+            content['degraded'] = True
+    for error in errors:
+        print(f'⚠️ [DEBUG] {error}')
+    print(f'✅ [DEBUG] Recovered {len(variants)}/{num_variants} variants for: {segment}')
+    content['variants'] = variants
+    content['variant_errors'] = errors
+    # The first variant doubles as the default content for single-variant consumers
+    content['subject'] = variants[0]['subject'] if variants else ''
+    content['html'] = variants[0]['html'] if variants else ''
+    return content
+
+
+def fallback_content(channel, state):
+    """Template-based content used when the LLM misses its deadline"""
+    segment = state.get('audience_segment') or ''
+    brief = state.get('intent_brief') or ''
+    subject = f"Picked for you: {segment}"[:120]
+    if channel == 'email':
+        html = (
+            '<div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto; padding: 24px;">'
+            f'<h1 style="font-size: 22px; color: #1a1a1a;">{escape(subject)}</h1>'
+            f'<p style="font-size: 16px; color: #333333; line-height: 1.5;">{escape(brief)}</p>'
+            '<a href="#" style="display: inline-block; padding: 12px 24px; background: #0067b8; color: #ffffff; text-decoration: none;">Learn more</a>'
+            '</div>'
+        )
+    else:
+        html = (
+            '<div style="font-family: Arial, sans-serif; width: 728px; height: 90px; padding: 12px; box-sizing: border-box; background: #0067b8; color: #ffffff;">'
+            f'<strong style="font-size: 18px;">{escape(subject)}</strong>'
+            f'<p style="font-size: 13px; margin: 4px 0 0 0;">{escape(brief[:140])}</p>'
+            '</div>'
+        )
+    content = {'type': channel, 'segment': segment, 'subject': subject, 'html': html, 'degraded': True}
+    if channel == 'banner':
+        content['css'] = ''
+    return content
+
+
 # --- New Subagents for Channel-Specific Content ---
 def email_content_subagent(state: CampaignState):
     """Generate email channel content (HTML/CSS) for a segment using LLM"""
     print(f"[EmailContentSubAgent] Generating email content for: {state.get('audience_segment')}")
+    if state.get('num_variants'):
+        return {'content': generate_content_variants('email', state)}
     if not llm:
         return {'content': {'type': 'email', 'segment': state.get('audience_segment'), 'html': '<p style="color: blue;">Stub email content</p>'}}
     prompt = ChatPromptTemplate.from_template(
@@ -435,15 +658,21 @@ def email_content_subagent(state: CampaignState):
         "BRIEF: {intent_brief}\nAUDIENCE SEGMENT: {audience_segment}\n"
         "Return only the HTML with inline CSS, no explanations."
     )
-    html = (prompt | llm | StrOutputParser()).invoke({
-        'intent_brief': state['intent_brief'],
-        'audience_segment': state['audience_segment']
-    })
+    try:
+        html = hedged_invoke('email_content', prompt | llm | StrOutputParser(), {
+            'intent_brief': state['intent_brief'],
+            'audience_segment': state['audience_segment']
+        }, state.get('deadline_at'))
+    except DeadlineExceeded as e:
+        print(f'⏱️ [EmailContentSubAgent] {e}, using fallback content')
+        return {'content': fallback_content('email', state)}
     return {'content': {'type': 'email', 'segment': state['audience_segment'], 'html': html}}
 
 def digital_banner_subagent(state: CampaignState):
     """Generate digital banner content (HTML/CSS) for a segment using LLM"""
     print(f"[DigitalBannerSubAgent] Generating banner content for: {state.get('audience_segment')}")
+    if state.get('num_variants'):
+        return {'content': generate_content_variants('banner', state)}
     if not llm:
         return {'content': {'type': 'banner', 'segment': state.get('audience_segment'), 'html': '<div>Stub banner</div>', 'css': 'div { background: yellow; }'}}
     prompt = ChatPromptTemplate.from_template(
@@ -451,21 +680,47 @@ def digital_banner_subagent(state: CampaignState):
         "BRIEF: {intent_brief}\nAUDIENCE SEGMENT: {audience_segment}\n"
         "Return only the HTML and CSS, no explanations."
     )
-    html_css = (prompt | llm | StrOutputParser()).invoke({
-        'intent_brief': state['intent_brief'],
-        'audience_segment': state['audience_segment']
-    })
+    try:
+        html_css = hedged_invoke('banner_content', prompt | llm | StrOutputParser(), {
+            'intent_brief': state['intent_brief'],
+            'audience_segment': state['audience_segment']
+        }, state.get('deadline_at'))
+    except DeadlineExceeded as e:
+        print(f'⏱️ [DigitalBannerSubAgent] {e}, using fallback content')
+        return {'content': fallback_content('banner', state)}
     return {'content': {'type': 'banner', 'segment': state['audience_segment'], 'html': html_css, 'css': ''}}
 
 # --- Channel Decision and Routing ---
+def decide_channel(intent_brief, segment, deadline_at):
+    """Use the LLM to pick 'email' or 'digital banner' for a segment; defaults to email without it"""
+    if not llm:
+        return 'email'
+    channel_decision_prompt = ChatPromptTemplate.from_template(
+        "Given the campaign brief and audience segment, should the content be delivered as an 'email' or 'digital banner'?\n"
+        "BRIEF: {intent_brief}\nSEGMENT: {audience_segment}\n"
+        "Return only 'email' or 'digital banner'."
+    )
+    try:
+        return hedged_invoke('channel_decision', channel_decision_prompt | llm | StrOutputParser(), {
+            'intent_brief': intent_brief,
+            'audience_segment': segment
+        }, deadline_at).strip().lower()
+    except DeadlineExceeded as e:
+        print(f'⏱️ [DEBUG] {e}, defaulting to email')
+        return 'email'
+
 def generate_content_for_segments(state: CampaignState):
     """Route to channel-specific subagents for each segment, aggregate results, and return to orchestrator."""
     print('---GENERATING CONTENT FOR EACH SEGMENT (ROUTED)---')
-    if not llm:
+    if not llm and not state.get('num_variants'):
         print('LLM not available, using fallback response')
         stub_content = [{'segment': 'Tech-savvy millennials', 'type': 'email', 'html': '<p>Stub email</p>', 'css': ''}]
-        return {'content': stub_content}
+        return {'content': run_html_pipeline(stub_content, state.get('deadline_at'))}
+    if not llm:
+        # Variants mode still goes through the subagents, which return stub variants
+        print('LLM not available, routing every segment to the email subagent stub')
     intent_brief = state['intent_brief']
+    content_deadline = stage_deadline(state.get('deadline_at'), 'content')
     audience_segments = state.get('audience_segments', [])
     print(f"[DEBUG] Input audience_segments: {audience_segments}")
     if isinstance(audience_segments, str):
@@ -473,23 +728,18 @@ def generate_content_for_segments(state: CampaignState):
     all_content = []
     for segment in audience_segments:
         print(f"[DEBUG] Processing segment: {segment}")
-        # Use LLM to decide channel
-        channel_decision_prompt = ChatPromptTemplate.from_template(
-            "Given the campaign brief and audience segment, should the content be delivered as an 'email' or 'digital banner'?\n"
-            "BRIEF: {intent_brief}\nSEGMENT: {audience_segment}\n"
-            "Return only 'email' or 'digital banner'."
-        )
-        channel = (channel_decision_prompt | llm | StrOutputParser()).invoke({
-            'intent_brief': intent_brief,
-            'audience_segment': segment
-        }).strip().lower()
+        channel = decide_channel(intent_brief, segment, content_deadline)
         print(f"Routing segment '{segment}' to channel: {channel}")
-        subagent_state = {'intent_brief': intent_brief, 'audience_segment': segment}
+        subagent_state = {'intent_brief': intent_brief, 'audience_segment': segment, 'deadline_at': content_deadline}
+        if state.get('num_variants'):
+            subagent_state['num_variants'] = state['num_variants']
         if 'email' in channel:
             result = email_content_subagent(subagent_state)
         else:
             result = digital_banner_subagent(subagent_state)
         all_content.append(result['content'])
+    # Strip fences, inline CSS, sanitize and validate before anything reaches the client
+    all_content = run_html_pipeline(all_content, state.get('deadline_at'))
     print(f'[DEBUG] All generated content: {all_content}')
     print(f'Generated content for {len(all_content)} segments')
     return {'content': all_content}
@@ -546,12 +796,12 @@ def campaign_orchestrator(state: CampaignState):
                 return new_state
 
         # Get orchestrator decision
-        next_step = orchestrator_chain.invoke({
+        next_step = hedged_invoke('orchestrator', orchestrator_chain, {
             'intent_brief': state['intent_brief'],
             'audience_segments': audience_segments,
             'has_content': has_content,
             'has_review': has_review
-        }).strip().lower()
+        }, stage_deadline(state.get('deadline_at'), 'orchestrator')).strip().lower()
 
         print(f'Orchestrator decided next step: {next_step}')
 
@@ -647,8 +897,22 @@ def run_campaign():
         
         intent_brief = data['intent_brief']
         
+        # Overall deadline, propagated to every stage through the graph state
+        deadline_seconds = data.get('deadline_seconds')
+        if deadline_seconds is not None and not valid_deadline_seconds(deadline_seconds):
+            return jsonify({'error': f'deadline_seconds must be a number greater than 0 and at most {latency.MAX_CAMPAIGN_DEADLINE_SECONDS}'}), 400
+        initial_state = {'intent_brief': intent_brief, 'deadline_at': new_deadline(deadline_seconds)}
+        
+        # Optional variants mode: N copy variants per segment for A/B testing
+        num_variants = data.get('variants')
+        if num_variants is not None:
+            if isinstance(num_variants, bool) or not isinstance(num_variants, int) or not MIN_VARIANTS <= num_variants <= MAX_VARIANTS:
+                return jsonify({'error': f'variants must be an integer between {MIN_VARIANTS} and {MAX_VARIANTS}'}), 400
+            initial_state['num_variants'] = num_variants
+        
         # Run the compiled graph with the intent brief
-        result = app_graph.invoke({'intent_brief': intent_brief})
+        result = app_graph.invoke(initial_state)
+        result.pop('deadline_at', None)
         
         # Return the final state as JSON
         return jsonify(result)
@@ -656,6 +920,11 @@ def run_campaign():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/latency-stats', methods=['GET'])
+def latency_stats():
+    """Hedging counters and observed p95 latency per LLM call"""
+    return jsonify(get_latency_stats())
+
 @app.route('/', methods=['GET'])
 def root():
     """Root endpoint"""
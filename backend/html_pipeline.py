@@ -0,0 +1,711 @@
+# HTML post-processing pipeline for generated channel content.
+# Kept free of Flask/LangChain imports so the stage itself is cheap to load.
+# Worker processes are started with spawn (the only start method on Windows,
+# and safe next to the app's threads elsewhere), so each worker also
+# re-imports app.py as __mp_main__ once when the pool starts. That import only
+# builds objects (Flask app, LLM client, graph) and never starts the server,
+# so the cost is paid once per worker, not per request.
+
+import os
+import re
+import time
+import threading
+import multiprocessing
+from html import escape
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+# Maximum size of a single piece of generated HTML (in UTF-8 bytes)
+MAX_HTML_BYTES = int(os.getenv('MAX_HTML_BYTES', '100000'))
+
+# Raw responses are cut at this multiple of MAX_HTML_BYTES before any parsing,
+# leaving room for fences and <style> blocks that the pipeline removes
+RAW_HTML_BYTES_FACTOR = 4
+
+# How long to wait for a worker per request: the time left before the request
+# deadline, capped at the timeout, but never less than the minimum
+HTML_PIPELINE_TIMEOUT_SECONDS = float(os.getenv('HTML_PIPELINE_TIMEOUT_SECONDS', '30'))
+HTML_PIPELINE_MIN_TIMEOUT_SECONDS = float(os.getenv('HTML_PIPELINE_MIN_TIMEOUT_SECONDS', '1'))
+
+# Number of worker processes; 0 disables the pool and processes in-line
+HTML_PIPELINE_WORKERS = int(os.getenv('HTML_PIPELINE_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# Start method for the worker processes
+HTML_PIPELINE_START_METHOD = os.getenv('HTML_PIPELINE_START_METHOD', 'spawn')
+
+# Elements that are removed together with everything inside them
+UNSAFE_TAGS = {
+    'script', 'style', 'iframe', 'object', 'embed', 'applet', 'frame', 'frameset', 'base', 'meta', 'link',
+    'svg', 'math', 'animate', 'set', 'template', 'noscript', 'xmp', 'noembed', 'noframes', 'form', 'textarea', 'select',
+}
+
+# Elements kept by the sanitizer; anything else is unwrapped (tag removed, content kept)
+ALLOWED_TAGS = {
+    'html', 'head', 'title', 'body', 'div', 'span', 'p', 'a', 'img', 'br', 'hr',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'strong', 'b', 'em', 'i', 'u', 's', 'small', 'sup', 'sub',
+    'ul', 'ol', 'li', 'dl', 'dt', 'dd', 'blockquote', 'pre', 'code',
+    'table', 'caption', 'colgroup', 'col', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th',
+    'center', 'font', 'section', 'header', 'footer', 'article', 'main', 'aside', 'nav', 'figure', 'figcaption',
+    'button', 'label',
+}
+
+# Attributes kept by the sanitizer (aria-* is also allowed)
+ALLOWED_ATTRIBUTES = {
+    'style', 'class', 'id', 'title', 'alt', 'href', 'src', 'target', 'rel', 'width', 'height',
+    'align', 'valign', 'bgcolor', 'background', 'border', 'cellpadding', 'cellspacing', 'color', 'face', 'size',
+    'colspan', 'rowspan', 'dir', 'lang', 'role', 'type',
+}
+
+# Attributes that carry a URL
+URL_ATTRIBUTES = {'href', 'src', 'background'}
+
+# URL schemes allowed in URL attributes; relative URLs and #fragments are always allowed
+ALLOWED_URL_SCHEMES = {'http', 'https', 'mailto'}
+
+# Elements that never have an end tag
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+# Elements whose end tag may legally be omitted
+OPTIONAL_END_TAGS = {'html', 'head', 'body', 'p', 'li', 'dt', 'dd', 'option', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th'}
+
+FENCE_RE = re.compile(r'```[a-zA-Z0-9_-]*[ \t]*\n(.*?)\n?[ \t]*```', re.DOTALL)
+STYLE_BLOCK_RE = re.compile(r'<style\b[^>]*>(.*?)</style\s*>', re.DOTALL | re.IGNORECASE)
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+SIMPLE_SELECTOR_RE = re.compile(r'^(\*|[a-zA-Z][a-zA-Z0-9-]*)?((?:[.#][a-zA-Z_-][a-zA-Z0-9_-]*)*)$')
+SELECTOR_PART_RE = re.compile(r'([.#])([a-zA-Z_-][a-zA-Z0-9_-]*)')
+URL_SCHEME_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*):')
+# ASCII whitespace and control characters, which browsers ignore inside URL schemes
+URL_IGNORED_CHARS_RE = re.compile(r'[\x00-\x20\x7f]+')
+UNSAFE_STYLE_RE = re.compile(r'expression\(|javascript:|vbscript:|behavior:|-moz-binding', re.IGNORECASE)
+
+
+def _format_attrs(attrs):
+    """Serialize (name, value) attribute pairs back to HTML"""
+    parts = []
+    for name, value in attrs:
+        if value is None:
+            parts.append(f' {name}')
+        else:
+            parts.append(f' {name}="{escape(value, quote=True)}"')
+    return ''.join(parts)
+
+
+class _HtmlRewriter(HTMLParser):
+    """
+    Re-emits the parsed document unchanged. Subclasses override rewrite_attrs()
+    and drop_tags to change what gets written out.
+    """
+
+    drop_tags = set()
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.out = []
+        self.drop_depth = 0
+        self.dropped_tag = None
+
+    def rewrite_attrs(self, tag, attrs):
+        return attrs
+
+    def handle_starttag(self, tag, attrs):
+        if self.drop_depth:
+            if tag == self.dropped_tag:
+                self.drop_depth += 1
+            return
+        if tag in self.drop_tags:
+            self.on_drop(tag)
+            if tag not in VOID_TAGS:
+                self.dropped_tag = tag
+                self.drop_depth = 1
+            return
+        self.out.append(f'<{tag}{_format_attrs(self.rewrite_attrs(tag, attrs))}>')
+
+    def handle_startendtag(self, tag, attrs):
+        if self.drop_depth:
+            return
+        if tag in self.drop_tags:
+            self.on_drop(tag)
+            return
+        self.out.append(f'<{tag}{_format_attrs(self.rewrite_attrs(tag, attrs))} />')
+
+    def handle_endtag(self, tag):
+        if self.drop_depth:
+            if tag == self.dropped_tag:
+                self.drop_depth -= 1
+                if not self.drop_depth:
+                    self.dropped_tag = None
+            return
+        if tag in self.drop_tags:
+            return
+        self.out.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if not self.drop_depth:
+            self.out.append(data)
+
+    def handle_entityref(self, name):
+        if not self.drop_depth:
+            self.out.append(f'&{name};')
+
+    def handle_charref(self, name):
+        if not self.drop_depth:
+            self.out.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        if not self.drop_depth:
+            self.out.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.out.append(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        # Processing instructions have no meaning in email/banner HTML
+        pass
+
+    def on_drop(self, tag):
+        pass
+
+    def rewrite(self, html):
+        self.feed(html)
+        self.close()
+        return ''.join(self.out)
+
+
+# --- Stage 1: markdown fences ---
+def strip_markdown_fences(html):
+    """Remove ```html ... ``` wrappers the LLM tends to add around its output"""
+    if not html:
+        return '', False
+    # The fenced block may be preceded by prose such as "Here is the email:"
+    match = FENCE_RE.search(html)
+    if match:
+        return match.group(1).strip(), True
+    # Unterminated fence, e.g. when the response was cut off
+    fence_start = html.find('```')
+    if fence_start != -1:
+        first_newline = html.find('\n', fence_start)
+        body = html[first_newline + 1:] if first_newline != -1 else ''
+        return body.rstrip('`').strip(), True
+    return html.strip(), False
+
+
+# --- Stage 2: CSS inlining ---
+def _strip_at_rules(css):
+    """Remove @media/@font-face/... blocks, which cannot be inlined. Returns (css, dropped_count)."""
+    out = []
+    dropped = 0
+    i = 0
+    while i < len(css):
+        if css[i] == '@':
+            dropped += 1
+            brace = css.find('{', i)
+            semi = css.find(';', i)
+            # Statement at-rule such as @import url(...);
+            if semi != -1 and (brace == -1 or semi < brace):
+                i = semi + 1
+                continue
+            if brace == -1:
+                break
+            depth = 0
+            j = brace
+            while j < len(css):
+                if css[j] == '{':
+                    depth += 1
+                elif css[j] == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                j += 1
+            i = j + 1
+            continue
+        out.append(css[i])
+        i += 1
+    return ''.join(out), dropped
+
+
+def _parse_selector(selector):
+    """Parse a simple selector (tag, .class, #id or a compound of those). Returns None if unsupported."""
+    match = SIMPLE_SELECTOR_RE.match(selector)
+    if not match or not selector:
+        return None
+    tag = (match.group(1) or '*').lower()
+    classes = set()
+    element_id = None
+    for kind, name in SELECTOR_PART_RE.findall(match.group(2)):
+        if kind == '.':
+            classes.add(name)
+        else:
+            element_id = name
+    specificity = (1 if element_id else 0, len(classes), 0 if tag == '*' else 1)
+    return {'tag': tag, 'classes': classes, 'id': element_id, 'specificity': specificity}
+
+
+def parse_css_rules(css):
+    """
+    Parse a stylesheet into a list of rules that can be inlined.
+    Returns (rules, skipped_count) where skipped_count counts at-rules and
+    selectors with combinators or pseudo-classes.
+    """
+    css = CSS_COMMENT_RE.sub('', css)
+    css, skipped = _strip_at_rules(css)
+    rules = []
+    order = 0
+    for block in css.split('}'):
+        if '{' not in block:
+            continue
+        selectors, declarations = block.split('{', 1)
+        declarations = ';'.join(d.strip() for d in declarations.split(';') if ':' in d)
+        if not declarations:
+            continue
+        for selector in selectors.split(','):
+            parsed = _parse_selector(selector.strip())
+            if parsed is None:
+                skipped += 1
+                continue
+            parsed['declarations'] = declarations
+            parsed['order'] = order
+            order += 1
+            rules.append(parsed)
+    rules.sort(key=lambda rule: (rule['specificity'], rule['order']))
+    return rules, skipped
+
+
+class _CssInliner(_HtmlRewriter):
+    drop_tags = {'style'}
+
+    def __init__(self, rules):
+        super().__init__()
+        self.rules = rules
+
+    def rewrite_attrs(self, tag, attrs):
+        attr_map = dict(attrs)
+        classes = set((attr_map.get('class') or '').split())
+        element_id = attr_map.get('id')
+        matched = [
+            rule['declarations'] for rule in self.rules
+            if rule['tag'] in ('*', tag)
+            and rule['classes'] <= classes
+            and (rule['id'] is None or rule['id'] == element_id)
+        ]
+        if not matched:
+            return attrs
+        # Existing inline styles come last so they keep precedence
+        existing = (attr_map.get('style') or '').strip().rstrip(';')
+        if existing:
+            matched.append(existing)
+        style = '; '.join(matched)
+        return [(name, value) for name, value in attrs if name != 'style'] + [('style', style)]
+
+
+def inline_css(html, extra_css=''):
+    """Move rules from <style> blocks (and any separately returned CSS) into style attributes"""
+    stylesheets = STYLE_BLOCK_RE.findall(html)
+    if extra_css:
+        stylesheets.append(extra_css)
+    if not stylesheets:
+        return html, {'rules_inlined': 0, 'rules_skipped': 0}
+    rules, skipped = parse_css_rules('\n'.join(stylesheets))
+    inlined = _CssInliner(rules).rewrite(html)
+    return inlined, {'rules_inlined': len(rules), 'rules_skipped': skipped}
+
+
+# --- Stage 3: sanitization ---
+def is_safe_url(url):
+    """Allow relative URLs, #fragments and http/https/mailto; reject every other scheme"""
+    # Attribute values arrive entity-decoded, so java&#x09;script: is already java\tscript: here
+    normalized = URL_IGNORED_CHARS_RE.sub('', url or '')
+    match = URL_SCHEME_RE.match(normalized)
+    return match is None or match.group(1).lower() in ALLOWED_URL_SCHEMES
+
+
+class _Sanitizer(_HtmlRewriter):
+    drop_tags = UNSAFE_TAGS
+
+    def __init__(self):
+        super().__init__()
+        self.removed = {'tags': 0, 'unknown_tags': 0, 'attributes': 0, 'event_handlers': 0, 'unsafe_urls': 0}
+
+    def on_drop(self, tag):
+        self.removed['tags'] += 1
+
+    def handle_starttag(self, tag, attrs):
+        if not self.drop_depth and tag not in UNSAFE_TAGS and tag not in ALLOWED_TAGS:
+            self.removed['unknown_tags'] += 1
+            return
+        super().handle_starttag(tag, attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.drop_depth and tag not in UNSAFE_TAGS and tag not in ALLOWED_TAGS:
+            self.removed['unknown_tags'] += 1
+            return
+        super().handle_startendtag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if not self.drop_depth and tag not in UNSAFE_TAGS and tag not in ALLOWED_TAGS:
+            return
+        super().handle_endtag(tag)
+
+    def handle_comment(self, data):
+        # Conditional comments can carry markup that some clients execute
+        pass
+
+    def handle_data(self, data):
+        # On close() HTMLParser hands a trailing unterminated tag such as
+        # '<img src=x onerror=alert(1)' to handle_data; escape it so it stays text.
+        # Entities arrive via handle_entityref/handle_charref, so this is lossless.
+        super().handle_data(data.replace('<', '&lt;').replace('>', '&gt;'))
+
+    def rewrite_attrs(self, tag, attrs):
+        clean = []
+        for name, value in attrs:
+            if name.startswith('on'):
+                self.removed['event_handlers'] += 1
+                continue
+            if name not in ALLOWED_ATTRIBUTES and not name.startswith('aria-'):
+                self.removed['attributes'] += 1
+                continue
+            if name in URL_ATTRIBUTES and not is_safe_url(value):
+                self.removed['unsafe_urls'] += 1
+                continue
+            if name == 'style' and value and UNSAFE_STYLE_RE.search(URL_IGNORED_CHARS_RE.sub('', value)):
+                self.removed['unsafe_urls'] += 1
+                continue
+            clean.append((name, value))
+        return clean
+
+
+def sanitize_html(html):
+    """
+    Keep only allowlisted tags and attributes. Scripts, frames, SVG/MathML and
+    other unsafe elements are removed with their content, and URLs must use an
+    allowed scheme.
+    """
+    sanitizer = _Sanitizer()
+    return sanitizer.rewrite(html), sanitizer.removed
+
+
+# --- Stage 4: size limit ---
+def cap_raw_input(html, max_bytes=MAX_HTML_BYTES):
+    """Cheap byte cut applied before parsing so oversized responses do not go through every stage"""
+    limit = max_bytes * RAW_HTML_BYTES_FACTOR
+    encoded = html.encode('utf-8')
+    if len(encoded) <= limit:
+        return html, False
+    # A tag cut in half here is escaped into text by the sanitizer
+    return encoded[:limit].decode('utf-8', errors='ignore'), True
+
+
+class _TokenBoundaries(HTMLParser):
+    """Records where each token (tag, text run, entity, comment) starts in the source"""
+
+    def __init__(self, html):
+        super().__init__(convert_charrefs=False)
+        # HTMLParser.getpos() counts lines by '\n' only
+        self.line_offsets = [0] + [match.end() for match in re.finditer('\n', html)]
+        self.tokens = []
+
+    def _mark(self, kind):
+        line, column = self.getpos()
+        self.tokens.append((self.line_offsets[line - 1] + column, kind))
+
+    def handle_starttag(self, tag, attrs):
+        self._mark('tag')
+
+    def handle_startendtag(self, tag, attrs):
+        self._mark('tag')
+
+    def handle_endtag(self, tag):
+        self._mark('tag')
+
+    def handle_data(self, data):
+        self._mark('data')
+
+    def handle_entityref(self, name):
+        self._mark('tag')
+
+    def handle_charref(self, name):
+        self._mark('tag')
+
+    def handle_comment(self, data):
+        self._mark('tag')
+
+    def handle_decl(self, decl):
+        self._mark('tag')
+
+
+def enforce_size_limit(html, max_bytes=MAX_HTML_BYTES):
+    """
+    Truncate HTML that exceeds max_bytes without cutting through a tag or entity.
+    Text runs may be cut anywhere. Returns (html, truncated).
+    """
+    encoded = html.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return html, False
+    # Longest prefix (in characters) that fits in max_bytes
+    limit = len(encoded[:max_bytes].decode('utf-8', errors='ignore'))
+    parser = _TokenBoundaries(html)
+    parser.feed(html)
+    parser.close()
+    cut = 0
+    for start, kind in parser.tokens:
+        if start > limit:
+            break
+        cut = limit if kind == 'data' else start
+    return html[:cut], True
+
+
+# --- Stage 5: structure validation ---
+class _StructureValidator(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.stack = []
+        self.errors = []
+        self.warnings = []
+        self.text_length = 0
+        self.element_count = 0
+
+    def handle_starttag(self, tag, attrs):
+        self.element_count += 1
+        if tag not in VOID_TAGS:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.element_count += 1
+
+    def handle_endtag(self, tag):
+        if tag in VOID_TAGS:
+            return
+        if tag not in self.stack:
+            self.errors.append(f'Unexpected closing tag </{tag}>')
+            return
+        # Pop implicitly closed elements up to the matching start tag
+        while self.stack:
+            open_tag = self.stack.pop()
+            if open_tag == tag:
+                break
+            if open_tag not in OPTIONAL_END_TAGS:
+                self.errors.append(f'Unclosed <{open_tag}> before </{tag}>')
+
+    def handle_data(self, data):
+        self.text_length += len(data.strip())
+
+
+def validate_html_structure(html):
+    """Check that the HTML is well formed enough to render and has visible content"""
+    validator = _StructureValidator()
+    validator.feed(html)
+    validator.close()
+    for open_tag in validator.stack:
+        if open_tag not in OPTIONAL_END_TAGS:
+            validator.errors.append(f'Unclosed <{open_tag}> at end of document')
+    if not validator.element_count:
+        validator.errors.append('No HTML elements found')
+    if not validator.text_length:
+        validator.warnings.append('No visible text content')
+    return {
+        'valid': not validator.errors,
+        'errors': validator.errors,
+        'warnings': validator.warnings,
+    }
+
+
+def _process_html(item, max_bytes=MAX_HTML_BYTES):
+    """Run all pipeline stages on one piece of HTML (and its separate CSS, if any)"""
+    timings = {}
+    processed = dict(item)
+
+    start = time.perf_counter()
+    html, raw_truncated = cap_raw_input(item.get('html') or '', max_bytes)
+    timings['raw_size_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    start = time.perf_counter()
+    html, fenced = strip_markdown_fences(html)
+    css, _ = strip_markdown_fences(item.get('css') or '')
+    timings['strip_fences_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    start = time.perf_counter()
+    html, css_stats = inline_css(html, css)
+    timings['inline_css_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    start = time.perf_counter()
+    html, removed = sanitize_html(html)
+    timings['sanitize_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    start = time.perf_counter()
+    html, truncated = enforce_size_limit(html, max_bytes)
+    timings['size_limit_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    start = time.perf_counter()
+    validation = validate_html_structure(html)
+    timings['validate_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    truncated = truncated or raw_truncated
+    if truncated:
+        validation['warnings'].append(f'HTML truncated to {max_bytes} bytes')
+    # Report what the model sent that had to be removed
+    if removed['tags']:
+        validation['warnings'].append(f"Removed {removed['tags']} disallowed elements (scripts, frames, SVG, ...)")
+    if removed['event_handlers'] or removed['unsafe_urls']:
+        validation['warnings'].append(
+            f"Removed {removed['event_handlers']} event handlers and {removed['unsafe_urls']} unsafe URLs")
+    validation.update({
+        'fences_stripped': fenced,
+        'truncated': truncated,
+        'size_bytes': len(html.encode('utf-8')),
+        'removed': removed,
+        **css_stats,
+    })
+    timings['total_ms'] = round(sum(timings.values()), 3)
+
+    processed['html'] = html
+    if 'css' in processed:
+        # Everything has been inlined into the HTML
+        processed['css'] = ''
+    processed['validation'] = validation
+    processed['timings'] = timings
+    return processed
+
+
+def _pipeline_tasks(item):
+    """Split an entry into independent tasks: the entry itself, or one task per A/B variant"""
+    if not item.get('variants'):
+        return [item]
+    # Variants share the entry's separately returned CSS, if any
+    css = item.get('css') or ''
+    return [{'segment': item.get('segment'), 'html': variant.get('html'), 'css': css} for variant in item['variants']]
+
+
+def _assemble(item, results):
+    """Put task results back together; an entry's own html/validation are those of variant 0"""
+    if not item.get('variants'):
+        return results[0]
+    processed = dict(item)
+    processed['variants'] = [
+        {**variant, 'html': result['html'], 'validation': result['validation'], 'timings': result['timings']}
+        for variant, result in zip(item['variants'], results)
+    ]
+    first = processed['variants'][0]
+    processed['html'] = first['html']
+    processed['validation'] = first['validation']
+    processed['timings'] = first['timings']
+    if 'css' in processed:
+        processed['css'] = ''
+    return processed
+
+
+def process_content_item(item, max_bytes=MAX_HTML_BYTES):
+    """Run all pipeline stages on one content entry and attach validation results and timings"""
+    return _assemble(item, [_process_html(task, max_bytes) for task in _pipeline_tasks(item)])
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=HTML_PIPELINE_WORKERS,
+                mp_context=multiprocessing.get_context(HTML_PIPELINE_START_METHOD),
+            )
+        return _executor
+
+
+def _discard_executor(executor):
+    """Shut down a broken pool so its worker processes are not leaked; the next call builds a new one"""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _failed_item(item, error):
+    """Entry returned when processing fails; the unprocessed HTML is never passed through"""
+    failed = dict(item)
+    failed['html'] = ''
+    if 'css' in failed:
+        failed['css'] = ''
+    failed.pop('variants', None)
+    failed['validation'] = {'valid': False, 'errors': [f'HTML pipeline failed: {type(error).__name__}: {error}'], 'warnings': []}
+    failed['timings'] = {'total_ms': 0.0}
+    return failed
+
+
+def _process_in_line(task):
+    try:
+        return _process_html(task)
+    except Exception as e:
+        print(f'❌ [DEBUG] HTML pipeline failed for \'{task.get("segment")}\': {type(e).__name__}: {e}')
+        return _failed_item(task, e)
+
+
+def _wait_until(deadline_at):
+    """Absolute time to stop waiting for workers, bounded by the request deadline"""
+    now = time.monotonic()
+    timeout = HTML_PIPELINE_TIMEOUT_SECONDS
+    if deadline_at is not None:
+        timeout = min(timeout, max(deadline_at - now, HTML_PIPELINE_MIN_TIMEOUT_SECONDS))
+    return now + timeout
+
+
+def run_html_pipeline(content_items, deadline_at=None):
+    """
+    Post-process a list of content entries across a process pool. Each entry,
+    or each A/B variant of an entry, is a separate task: a failing task, or one
+    not finished before deadline_at (monotonic), is reported as invalid without
+    failing the others. If the pool breaks, it is shut down and the remaining
+    tasks are processed in-line.
+    """
+    if not content_items:
+        return []
+    print(f'🧹 [DEBUG] Running HTML pipeline on {len(content_items)} content pieces')
+    start = time.perf_counter()
+    # Every entry, or every variant of an entry, is its own task so they spread across the pool
+    tasks = [_pipeline_tasks(item) for item in content_items]
+    flat_tasks = [task for item_tasks in tasks for task in item_tasks]
+    if HTML_PIPELINE_WORKERS > 0:
+        wait_until = _wait_until(deadline_at)
+        executor = _get_executor()
+        task_results = []
+        try:
+            futures = [executor.submit(_process_html, task) for task in flat_tasks]
+        except BrokenProcessPool as e:
+            print(f'❌ [DEBUG] HTML pipeline process pool is broken ({e}), processing in-line')
+            _discard_executor(executor)
+            futures = []
+        for index, task in enumerate(flat_tasks):
+            if index >= len(futures):
+                task_results.append(_process_in_line(task))
+                continue
+            try:
+                task_results.append(futures[index].result(timeout=max(0.0, wait_until - time.monotonic())))
+            except FutureTimeoutError:
+                futures[index].cancel()
+                print(f'❌ [DEBUG] HTML pipeline timed out for \'{task.get("segment")}\'')
+                task_results.append(_failed_item(task, TimeoutError('no result before the deadline')))
+            except BrokenProcessPool as e:
+                print(f'❌ [DEBUG] HTML pipeline process pool is broken ({e}), processing in-line')
+                _discard_executor(executor)
+                futures = futures[:index]
+                task_results.append(_process_in_line(task))
+            except Exception as e:
+                print(f'❌ [DEBUG] HTML pipeline failed for \'{task.get("segment")}\': {type(e).__name__}: {e}')
+                task_results.append(_failed_item(task, e))
+    else:
+        task_results = [_process_in_line(task) for task in flat_tasks]
+    results = []
+    for item, item_tasks in zip(content_items, tasks):
+        results.append(_assemble(item, task_results[:len(item_tasks)]))
+        task_results = task_results[len(item_tasks):]
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    for result in results:
+        validation = result['validation']
+        status = '✅' if validation['valid'] else '⚠️'
+        print(f"{status} [DEBUG] {result.get('type')} for '{result.get('segment')}': "
+              f"valid={validation['valid']}, errors={validation['errors']}, {result['timings']['total_ms']}ms")
+    print(f'🧹 [DEBUG] HTML pipeline finished in {elapsed_ms:.1f}ms')
+    return results
@@ -0,0 +1,285 @@
+# Tail-latency controls for LLM calls: per-request deadlines, per-stage budgets
+# and hedged requests. Works with anything exposing .invoke(inputs), so it can
+# be exercised against a local fake model with injected latency.
+
+import os
+import math
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Overall time budget for one /api/run-campaign request (seconds)
+CAMPAIGN_DEADLINE_SECONDS = float(os.getenv('CAMPAIGN_DEADLINE_SECONDS', '90'))
+
+# Largest deadline a request may ask for (seconds)
+MAX_CAMPAIGN_DEADLINE_SECONDS = float(os.getenv('MAX_CAMPAIGN_DEADLINE_SECONDS', '600'))
+
+# Per-stage budgets (seconds); a stage never gets more than what is left of the overall deadline
+STAGE_BUDGETS = {
+    'orchestrator': float(os.getenv('ORCHESTRATOR_BUDGET_SECONDS', '10')),
+    'audience': float(os.getenv('AUDIENCE_BUDGET_SECONDS', '30')),
+    'content': float(os.getenv('CONTENT_BUDGET_SECONDS', '45')),
+}
+
+HEDGING_ENABLED = os.getenv('HEDGING_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+
+# Hedge after the observed p95 once enough samples exist, otherwise after the default delay
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv('HEDGE_DEFAULT_DELAY_SECONDS', '15'))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv('HEDGE_MIN_DELAY_SECONDS', '1'))
+
+# Threads for LLM calls, and how many of them hedges may occupy at once
+LLM_CALL_WORKERS = int(os.getenv('LLM_CALL_WORKERS', '32'))
+MAX_HEDGES_IN_FLIGHT = int(os.getenv('MAX_HEDGES_IN_FLIGHT', '4'))
+LATENCY_WINDOW = 200
+
+# Settings that configure() may override
+_SETTINGS = {
+    'CAMPAIGN_DEADLINE_SECONDS', 'MAX_CAMPAIGN_DEADLINE_SECONDS', 'STAGE_BUDGETS', 'HEDGING_ENABLED', 'HEDGE_MIN_SAMPLES',
+    'HEDGE_DEFAULT_DELAY_SECONDS', 'HEDGE_MIN_DELAY_SECONDS', 'LLM_CALL_WORKERS', 'MAX_HEDGES_IN_FLIGHT',
+}
+
+_executor = None
+_lock = threading.Lock()
+_latencies = {}
+_counters = {}
+_in_flight = 0
+_hedges_in_flight = 0
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an LLM call does not finish before its stage deadline"""
+
+
+def configure(**settings):
+    """
+    Override settings that are otherwise read from the environment at import,
+    e.g. configure(hedge_min_samples=5, stage_budgets={'content': 1.0}).
+    stage_budgets is merged into the existing budgets. Returns the previous
+    values so they can be restored with configure(**previous).
+    """
+    global _executor
+    previous = {}
+    for key, value in settings.items():
+        name = key.upper()
+        if name not in _SETTINGS:
+            raise ValueError(f'Unknown latency setting: {key}')
+        if name == 'STAGE_BUDGETS':
+            previous[key] = dict(STAGE_BUDGETS)
+            STAGE_BUDGETS.update(value)
+        else:
+            previous[key] = globals()[name]
+            globals()[name] = value
+    if 'llm_call_workers' in settings:
+        with _lock:
+            old_executor, _executor = _executor, None
+        if old_executor is not None:
+            old_executor.shutdown(wait=False, cancel_futures=True)
+    return previous
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=LLM_CALL_WORKERS, thread_name_prefix='llm-call')
+        return _executor
+
+
+def valid_deadline_seconds(seconds):
+    """True if seconds is a usable request deadline: a finite number in (0, MAX_CAMPAIGN_DEADLINE_SECONDS]"""
+    return (
+        isinstance(seconds, (int, float)) and not isinstance(seconds, bool)
+        and math.isfinite(seconds) and 0 < seconds <= MAX_CAMPAIGN_DEADLINE_SECONDS
+    )
+
+
+def new_deadline(seconds=None):
+    """Absolute (monotonic) deadline for a request starting now"""
+    return time.monotonic() + (CAMPAIGN_DEADLINE_SECONDS if seconds is None else seconds)
+
+
+def stage_deadline(deadline_at, stage):
+    """Deadline for a stage: its own budget, capped by the overall request deadline"""
+    stage_end = time.monotonic() + STAGE_BUDGETS[stage]
+    return stage_end if deadline_at is None else min(deadline_at, stage_end)
+
+
+def time_left(deadline_at):
+    if deadline_at is None:
+        return None
+    return max(0.0, deadline_at - time.monotonic())
+
+
+def _count(name, counter):
+    counters = _counters.setdefault(name, {
+        'calls': 0, 'hedges_fired': 0, 'hedges_skipped': 0, 'hedge_wins': 0, 'deadline_exceeded': 0, 'errors': 0,
+    })
+    counters[counter] += 1
+
+
+class _Attempt:
+    """One request sent to the model (the primary or a hedge)"""
+
+    def __init__(self, name, is_hedge):
+        self.name = name
+        self.is_hedge = is_hedge
+        self.started = None
+        self.recorded = False
+
+
+def _record_latency(attempt, seconds):
+    """Record an attempt's latency once, whether it won, lost to a hedge or hit the deadline"""
+    with _lock:
+        if attempt.recorded:
+            return
+        attempt.recorded = True
+        _latencies.setdefault(attempt.name, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+
+def _run_attempt(attempt, runnable, inputs):
+    attempt.started = time.monotonic()
+    try:
+        return runnable.invoke(inputs)
+    finally:
+        # Recorded here rather than by the caller so losing and slowly failing attempts count too
+        _record_latency(attempt, time.monotonic() - attempt.started)
+
+
+def _attempt_finished(attempt, future):
+    global _in_flight, _hedges_in_flight
+    with _lock:
+        _in_flight -= 1
+        if attempt.is_hedge:
+            _hedges_in_flight -= 1
+
+
+def _submit(name, runnable, inputs, is_hedge=False):
+    global _in_flight, _hedges_in_flight
+    attempt = _Attempt(name, is_hedge)
+    with _lock:
+        _in_flight += 1
+        if is_hedge:
+            _hedges_in_flight += 1
+    try:
+        future = _get_executor().submit(_run_attempt, attempt, runnable, inputs)
+    except Exception:
+        _attempt_finished(attempt, None)
+        raise
+    future.add_done_callback(lambda done: _attempt_finished(attempt, done))
+    return future, attempt
+
+
+def _can_hedge():
+    """Skip hedging when the call pool is saturated or too many hedges are already running"""
+    with _lock:
+        return _in_flight < LLM_CALL_WORKERS and _hedges_in_flight < MAX_HEDGES_IN_FLIGHT
+
+
+def observed_p95(name):
+    """p95 latency of calls for name, or None until HEDGE_MIN_SAMPLES have been seen"""
+    with _lock:
+        samples = sorted(_latencies.get(name, ()))
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    # Nearest rank, so a single outlier in 20 samples is not the p95
+    return samples[math.ceil(0.95 * len(samples)) - 1]
+
+
+def hedge_delay(name):
+    p95 = observed_p95(name)
+    if p95 is None:
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    return max(HEDGE_MIN_DELAY_SECONDS, p95)
+
+
+def hedged_invoke(name, runnable, inputs, deadline_at=None):
+    """
+    Invoke runnable, firing a duplicate request if the first one takes longer
+    than the observed p95 for this call name. The first successful response
+    wins and the other request is cancelled if it has not started yet.
+    Raises DeadlineExceeded if nothing succeeds before deadline_at.
+    """
+    with _lock:
+        _count(name, 'calls')
+    if deadline_at is not None and time_left(deadline_at) <= 0:
+        with _lock:
+            _count(name, 'deadline_exceeded')
+        raise DeadlineExceeded(f'No time left for {name}')
+
+    primary, primary_attempt = _submit(name, runnable, inputs)
+    attempts = {primary: primary_attempt}
+    pending = {primary}
+    last_error = None
+    try:
+        delay = hedge_delay(name)
+        remaining = time_left(deadline_at)
+        if HEDGING_ENABLED and (remaining is None or delay < remaining):
+            done, _ = wait(pending, timeout=delay)
+            if not done:
+                if _can_hedge():
+                    print(f'⏱️ [DEBUG] {name} exceeded {delay:.2f}s, firing hedged request')
+                    hedge, hedge_attempt = _submit(name, runnable, inputs, is_hedge=True)
+                    attempts[hedge] = hedge_attempt
+                    pending.add(hedge)
+                    with _lock:
+                        _count(name, 'hedges_fired')
+                else:
+                    print(f'⏱️ [DEBUG] {name} exceeded {delay:.2f}s, call pool saturated, not hedging')
+                    with _lock:
+                        _count(name, 'hedges_skipped')
+
+        while pending:
+            done, pending = wait(pending, timeout=time_left(deadline_at), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if attempts[future].is_hedge:
+                    print(f'⏱️ [DEBUG] Hedged request won for {name}')
+                    with _lock:
+                        _count(name, 'hedge_wins')
+                return result
+
+        if last_error is not None and not pending:
+            with _lock:
+                _count(name, 'errors')
+            raise last_error
+        # Calls still running at the deadline count with the time they have taken so far
+        now = time.monotonic()
+        for future in pending:
+            attempt = attempts[future]
+            if attempt.started is not None:
+                _record_latency(attempt, now - attempt.started)
+        with _lock:
+            _count(name, 'deadline_exceeded')
+        raise DeadlineExceeded(f'{name} did not finish before its deadline')
+    finally:
+        # Requests that have not started yet are dropped; running ones cannot be interrupted
+        for future in pending:
+            future.cancel()
+
+
+def get_latency_stats():
+    """Counters, hedge rate/win rate and observed p95 for every call name"""
+    with _lock:
+        names = set(_counters) | set(_latencies)
+        stats = {name: dict(_counters.get(name, {})) for name in names}
+    for name, counters in stats.items():
+        calls = counters.get('calls', 0)
+        hedges = counters.get('hedges_fired', 0)
+        counters['hedge_rate'] = round(hedges / calls, 4) if calls else 0.0
+        counters['hedge_win_rate'] = round(counters.get('hedge_wins', 0) / hedges, 4) if hedges else 0.0
+        counters['p95_seconds'] = observed_p95(name)
+    return stats
+
+
+def reset_latency_stats():
+    with _lock:
+        _latencies.clear()
+        _counters.clear()
@@ -0,0 +1,34 @@
+import threading
+
+
+class FakeLatencyModel:
+    """
+    Local stand-in for the LLM with injected latency. Each call takes the next
+    entry from script, either a delay in seconds or a (delay, exception) pair
+    that raises after the delay; the last entry repeats once the script runs
+    out. release() wakes up every sleeping call so abandoned calls end quickly.
+    """
+
+    def __init__(self, script, response='ok'):
+        self.script = list(script)
+        self.response = response
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._released = threading.Event()
+
+    def invoke(self, inputs):
+        with self._lock:
+            entry = self.script[min(self.calls, len(self.script) - 1)]
+            self.calls += 1
+            call_number = self.calls
+        delay, error = entry if isinstance(entry, tuple) else (entry, None)
+        self._released.wait(delay)
+        if error is not None:
+            raise error
+        return self.response if not callable(self.response) else self.response(call_number, inputs)
+
+    def __call__(self, inputs):
+        return self.invoke(inputs)
+
+    def release(self):
+        self._released.set()
@@ -0,0 +1,148 @@
+import time
+
+import pytest
+
+# app.py needs the ODBC driver at import time
+pytest.importorskip('pyodbc', exc_type=ImportError)
+
+from langchain_core.runnables import RunnableLambda
+
+import app
+import latency
+from fake_model import FakeLatencyModel
+
+
+class FakeCursor:
+    """Answers the queries generate_audience makes with a small fixed dataset"""
+
+    ROWS = {
+        'Distinct_Products': [('Surface Laptop, Surface Pro',), ('Surface Pro',)],
+        'Distinct_Locations': [('New York',), ('Chicago',)],
+        'Distinct_Behaviors': [('Frequent online shopping',)],
+    }
+
+    def __init__(self):
+        self.rows = []
+
+    def execute(self, query, *params):
+        if '@@VERSION' in query:
+            self.rows = [('Microsoft SQL Server 2022',)]
+        elif 'INFORMATION_SCHEMA' in query:
+            self.rows = [('id', 'int'), ('name', 'nvarchar')]
+        else:
+            self.rows = next(rows for table, rows in self.ROWS.items() if table in query)
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def cursor(self):
+        return FakeCursor()
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def latency_settings():
+    previous = latency.configure(hedging_enabled=False)
+    latency.reset_latency_stats()
+    yield
+    latency.configure(**previous)
+    latency.reset_latency_stats()
+
+
+@pytest.fixture
+def hung_model():
+    model = FakeLatencyModel([5.0])
+    yield model
+    model.release()
+
+
+STATE = {'intent_brief': 'Launch the new Surface Laptop', 'audience_segment': 'Students'}
+
+
+def test_audience_deadline_uses_data_driven_fallback(monkeypatch, hung_model):
+    fallback_calls = []
+    build_fallback_segments = app.build_fallback_segments
+
+    def spy(*args):
+        fallback_calls.append(args)
+        return build_fallback_segments(*args)
+
+    monkeypatch.setattr(app, 'build_fallback_segments', spy)
+    monkeypatch.setattr(app.pyodbc, 'connect', lambda connection_string: FakeConnection())
+    monkeypatch.setattr(app, 'audience_chain', hung_model)
+    previous = latency.configure(stage_budgets={'audience': 0.2})
+    try:
+        start = time.monotonic()
+        result = app.generate_audience({'intent_brief': STATE['intent_brief'], 'deadline_at': latency.new_deadline(60)})
+    finally:
+        latency.configure(**previous)
+    assert time.monotonic() - start < 2
+    products, locations, behaviors = fallback_calls[0]
+    assert sorted(products) == ['Surface Laptop', 'Surface Pro']
+    assert result['audience_segments'] == build_fallback_segments(products, locations, behaviors)
+    assert latency.get_latency_stats()['audience']['deadline_exceeded'] == 1
+
+
+@pytest.mark.parametrize('subagent, channel', [
+    (app.email_content_subagent, 'email'),
+    (app.digital_banner_subagent, 'banner'),
+])
+def test_content_deadline_uses_fallback_content(monkeypatch, hung_model, subagent, channel):
+    monkeypatch.setattr(app, 'llm', RunnableLambda(hung_model))
+    result = subagent({**STATE, 'deadline_at': latency.new_deadline(0.2)})
+    assert result['content'] == app.fallback_content(channel, STATE)
+    assert result['content']['degraded']
+
+
+def test_channel_decision_deadline_defaults_to_email(monkeypatch, hung_model):
+    monkeypatch.setattr(app, 'llm', RunnableLambda(hung_model))
+    assert app.decide_channel(STATE['intent_brief'], 'Students', latency.new_deadline(0.2)) == 'email'
+
+
+def test_content_uses_llm_within_deadline(monkeypatch):
+    model = FakeLatencyModel([0.0], response='<p>Hello students</p>')
+    monkeypatch.setattr(app, 'llm', RunnableLambda(model))
+    result = app.email_content_subagent({**STATE, 'deadline_at': latency.new_deadline(5)})
+    assert result['content']['html'] == '<p>Hello students</p>'
+    assert 'degraded' not in result['content']
+
+
+def test_llm_error_still_propagates(monkeypatch):
+    model = FakeLatencyModel([(0.0, RuntimeError('quota exceeded'))])
+    monkeypatch.setattr(app, 'llm', RunnableLambda(model))
+    with pytest.raises(RuntimeError, match='quota exceeded'):
+        app.email_content_subagent({**STATE, 'deadline_at': latency.new_deadline(5)})
+    assert latency.get_latency_stats()['email_content']['errors'] == 1
+
+
+def test_latency_stats_endpoint(hung_model):
+    latency.configure(hedging_enabled=True, hedge_default_delay_seconds=0.05)
+    model = FakeLatencyModel([5.0, 0.0])
+    try:
+        latency.hedged_invoke('audience', model, {})
+    finally:
+        model.release()
+    response = app.app.test_client().get('/api/latency-stats')
+    assert response.status_code == 200
+    stats = response.get_json()['audience']
+    assert stats['calls'] == 1
+    assert stats['hedges_fired'] == 1
+    assert stats['hedge_wins'] == 1
+    assert stats['hedge_rate'] == 1.0
+
+
+@pytest.mark.parametrize('deadline_seconds', ['-1', '0', 'NaN', 'Infinity', '100000', 'true', '"30"'])
+def test_run_campaign_rejects_invalid_deadline(deadline_seconds):
+    response = app.app.test_client().post(
+        '/api/run-campaign',
+        data='{"intent_brief": "x", "deadline_seconds": %s}' % deadline_seconds,
+        content_type='application/json',
+    )
+    assert response.status_code == 400
@@ -0,0 +1,305 @@
+import time
+
+import pytest
+
+import html_pipeline
+from html_pipeline import (
+    strip_markdown_fences, inline_css, sanitize_html, enforce_size_limit,
+    validate_html_structure, process_content_item, run_html_pipeline, is_safe_url,
+)
+
+
+# --- Fences ---
+def test_strip_fences_at_start():
+    assert strip_markdown_fences('```html\n<p>x</p>\n```') == ('<p>x</p>', True)
+
+
+def test_strip_fences_after_prose():
+    html, fenced = strip_markdown_fences('Here is the email:\n```html\n<p>x</p>\n```\nLet me know!')
+    assert (html, fenced) == ('<p>x</p>', True)
+
+
+def test_strip_unterminated_fence():
+    assert strip_markdown_fences('```html\n<p>x</p>') == ('<p>x</p>', True)
+
+
+def test_no_fence_is_untouched():
+    assert strip_markdown_fences('  <p>x</p>\n') == ('<p>x</p>', False)
+
+
+# --- CSS inlining ---
+def test_inline_css_moves_style_block_into_attributes():
+    html, stats = inline_css('<style>p { color: red }</style><p>x</p>')
+    assert html == '<p style="color: red">x</p>'
+    assert stats == {'rules_inlined': 1, 'rules_skipped': 0}
+
+
+def test_inline_css_orders_by_specificity_and_keeps_inline_style_last():
+    html, _ = inline_css(
+        '<style>#hero { color: green } .cta { color: blue } p { color: red }</style>'
+        '<p id="hero" class="cta" style="color: black">x</p>'
+    )
+    assert 'style="color: red; color: blue; color: green; color: black"' in html
+
+
+def test_inline_css_skips_media_queries_and_combinators():
+    html, stats = inline_css(
+        '<style>@media (max-width: 600px) { p { color: red } } div p { color: blue } .a { margin: 0 }</style>'
+        '<div><p class="a">x</p></div>'
+    )
+    assert html == '<div><p class="a" style="margin: 0">x</p></div>'
+    assert stats == {'rules_inlined': 1, 'rules_skipped': 2}
+
+
+def test_inline_css_uses_separately_returned_css():
+    html, _ = inline_css('<div>banner</div>', 'div { background: yellow; }')
+    assert html == '<div style="background: yellow">banner</div>'
+
+
+# --- Sanitization ---
+def test_sanitize_removes_scripts_frames_and_event_handlers():
+    html, removed = sanitize_html(
+        '<div onclick="steal()"><script>alert(1)</script>Hi<iframe src="https://x.test"></iframe></div>'
+    )
+    assert html == '<div>Hi</div>'
+    assert removed['tags'] == 2
+    assert removed['event_handlers'] == 1
+
+
+@pytest.mark.parametrize('html', [
+    '<a href="javascript:alert(1)">x</a>',
+    '<a href="java\tscript:alert(1)">x</a>',
+    '<a href="java&#x09;script:alert(1)">x</a>',
+    '<a href="java\nscript:alert(1)">x</a>',
+    '<a href=" &#x01;JaVaScRiPt:alert(1)">x</a>',
+    '<a href="vbscript:msgbox(1)">x</a>',
+    '<a href="data:text/html,<script>alert(1)</script>">x</a>',
+])
+def test_sanitize_removes_script_urls(html):
+    cleaned, removed = sanitize_html(html)
+    assert cleaned == '<a>x</a>'
+    assert removed['unsafe_urls'] == 1
+
+
+@pytest.mark.parametrize('html, expected', [
+    ('<p>Sale</p><img src=x onerror=alert(1) ', '<p>Sale</p>&lt;img src=x onerror=alert(1) '),
+    ('<p>Sale</p><a href="javascript:alert(1)" ', '<p>Sale</p>&lt;a href="javascript:alert(1)" '),
+])
+def test_sanitize_escapes_trailing_unterminated_tag(html, expected):
+    assert sanitize_html(html)[0] == expected
+
+
+def test_sanitize_escapes_angle_brackets_in_text_but_keeps_entities():
+    assert sanitize_html('<p>1 &lt; 2 &amp; 3 > 2</p>')[0] == '<p>1 &lt; 2 &amp; 3 &gt; 2</p>'
+
+
+def test_process_content_item_neutralizes_truncated_event_handler():
+    result = process_content_item({'html': '<p>Sale</p><img src=x onerror=alert(1) '})
+    assert '<img' not in result['html']
+    assert result['html'].startswith('<p>Sale</p>&lt;img')
+
+
+def test_sanitize_removes_svg_and_smil():
+    html, _ = sanitize_html(
+        '<svg><animate attributeName="href" values="javascript:alert(1)"/><a><text>x</text></a></svg>'
+        '<set attributeName="href" to="javascript:alert(1)"/><p>ok</p>'
+    )
+    assert html == '<p>ok</p>'
+
+
+def test_sanitize_keeps_allowed_urls():
+    html = '<a href="https://example.com">a</a><a href="mailto:a@b.test">b</a><a href="#top">c</a><a href="/offers">d</a>'
+    assert sanitize_html(html)[0] == html
+
+
+def test_sanitize_unwraps_unknown_tags_and_drops_unknown_attributes():
+    html, removed = sanitize_html('<p data-x="1" class="c"><blink>Sale</blink></p><!--[if mso]><x><![endif]-->')
+    assert html == '<p class="c">Sale</p>'
+    assert removed['unknown_tags'] == 1
+    assert removed['attributes'] == 1
+
+
+def test_sanitize_removes_script_in_style_attribute():
+    html, _ = sanitize_html('<div style="background: url(java\tscript:alert(1))">x</div>')
+    assert html == '<div>x</div>'
+
+
+@pytest.mark.parametrize('url, safe', [
+    ('https://example.com', True),
+    ('HTTP://example.com', True),
+    ('offers/today', True),
+    ('#top', True),
+    ('', True),
+    ('javascript:alert(1)', False),
+    ('\x01javascript:alert(1)', False),
+    ('ftp://example.com', False),
+])
+def test_is_safe_url(url, safe):
+    assert is_safe_url(url) is safe
+
+
+# --- Size limit ---
+def test_size_limit_leaves_small_html_alone():
+    assert enforce_size_limit('<p>x</p>', 100) == ('<p>x</p>', False)
+
+
+def test_size_limit_does_not_cut_inside_attribute_value():
+    assert enforce_size_limit('<p title="a>b">' + 'x' * 20, 12) == ('', True)
+
+
+def test_size_limit_cuts_text_but_not_tags_or_entities():
+    assert enforce_size_limit('<p>hello world</p>', 10) == ('<p>hello w', True)
+    assert enforce_size_limit('<p>a &amp; b</p>', 7) == ('<p>a ', True)
+    assert enforce_size_limit('<p>ab</p><p>cd</p>', 11) == ('<p>ab</p>', True)
+
+
+def test_size_limit_counts_bytes_not_characters():
+    html, truncated = enforce_size_limit('<p>' + 'é' * 10 + '</p>', 9)
+    assert truncated
+    assert html == '<p>' + 'é' * 3
+    assert len(html.encode('utf-8')) <= 9
+
+
+# --- Validation ---
+def test_validation_accepts_well_formed_html():
+    assert validate_html_structure('<div><p>Hello</div>') == {'valid': True, 'errors': [], 'warnings': []}
+
+
+def test_validation_reports_structure_errors():
+    result = validate_html_structure('<div><span>x</div></table>')
+    assert not result['valid']
+    assert result['errors'] == ['Unclosed <span> before </div>', 'Unexpected closing tag </table>']
+
+
+def test_validation_reports_unclosed_and_empty_documents():
+    assert validate_html_structure('<div>x')['errors'] == ['Unclosed <div> at end of document']
+    result = validate_html_structure('just text')
+    assert result['errors'] == ['No HTML elements found']
+
+
+def test_process_content_item_attaches_validation_and_timings():
+    item = {
+        'type': 'banner', 'segment': 's',
+        'html': '```html\n<div class="b" onmouseover="x()">Buy</div>\n```', 'css': '.b { color: red }',
+    }
+    result = process_content_item(item)
+    assert result['html'] == '<div class="b" style="color: red">Buy</div>'
+    assert result['css'] == ''
+    assert result['validation']['valid']
+    assert result['validation']['fences_stripped']
+    assert result['validation']['removed']['event_handlers'] == 1
+    assert set(result['timings']) == {
+        'raw_size_ms', 'strip_fences_ms', 'inline_css_ms', 'sanitize_ms', 'size_limit_ms', 'validate_ms', 'total_ms',
+    }
+
+
+def test_process_content_item_cuts_raw_input_before_parsing(monkeypatch):
+    calls = []
+    real_inline_css = html_pipeline.inline_css
+
+    def spy(html, extra_css=''):
+        calls.append(len(html))
+        return real_inline_css(html, extra_css)
+
+    monkeypatch.setattr(html_pipeline, 'inline_css', spy)
+    result = process_content_item({'html': '<p>' + 'x' * 10000 + '</p>'}, max_bytes=20)
+    assert calls == [20 * html_pipeline.RAW_HTML_BYTES_FACTOR]
+    assert result['validation']['truncated']
+    assert result['validation']['size_bytes'] <= 20
+
+
+def test_process_content_item_reports_removed_content():
+    result = process_content_item({'html': '<div onclick="x()"><script>alert(1)</script>Hi</div>'})
+    assert result['validation']['valid']
+    assert result['validation']['warnings'] == [
+        'Removed 1 disallowed elements (scripts, frames, SVG, ...)',
+        'Removed 1 event handlers and 0 unsafe URLs',
+    ]
+
+
+def test_process_content_item_truncates_oversized_html():
+    result = process_content_item({'html': '<p>' + 'x' * 100 + '</p>'}, max_bytes=20)
+    assert result['validation']['truncated']
+    assert result['validation']['size_bytes'] <= 20
+    assert 'HTML truncated to 20 bytes' in result['validation']['warnings']
+
+
+def test_process_content_item_processes_variants():
+    item = {'html': '<p>a</p>', 'variants': [{'subject': 's', 'html': '```html\n<p onclick="x()">v</p>\n```'}]}
+    result = process_content_item(item)
+    variant = result['variants'][0]
+    assert variant['subject'] == 's'
+    assert variant['html'] == '<p>v</p>'
+    assert variant['validation']['valid']
+    # The entry itself mirrors variant 0
+    assert result['html'] == variant['html']
+    assert result['validation'] is variant['validation']
+
+
+def test_run_html_pipeline_processes_each_variant_once(monkeypatch):
+    monkeypatch.setattr(html_pipeline, 'HTML_PIPELINE_WORKERS', 0)
+    processed = []
+    real_process_html = html_pipeline._process_html
+
+    def spy(task, *args):
+        processed.append(task['html'])
+        return real_process_html(task, *args)
+
+    monkeypatch.setattr(html_pipeline, '_process_html', spy)
+    item = {
+        'type': 'banner', 'segment': 's', 'html': '<p>1</p>', 'css': 'p { color: red }',
+        'variants': [{'subject': 'a', 'html': '<p>1</p>'}, {'subject': 'b', 'html': '<p>2</p>'}],
+    }
+    result = run_html_pipeline([item, ITEMS[0]])
+    assert processed == ['<p>1</p>', '<p>2</p>', '<p onclick="x()">A</p>']
+    assert [v['html'] for v in result[0]['variants']] == ['<p style="color: red">1</p>', '<p style="color: red">2</p>']
+    assert result[0]['html'] == '<p style="color: red">1</p>'
+    assert result[1]['html'] == '<p>A</p>'
+
+
+def test_run_html_pipeline_spreads_variants_across_pool(monkeypatch):
+    monkeypatch.setattr(html_pipeline, 'HTML_PIPELINE_WORKERS', 2)
+    item = {'segment': 's', 'html': '<p>1</p>', 'variants': [{'subject': 'a', 'html': '<p>1</p>'}, {'subject': 'b', 'html': 42}]}
+    result = run_html_pipeline([item])[0]
+    # A failing variant is reported on its own without affecting the others
+    assert result['variants'][0]['validation']['valid']
+    assert result['variants'][1]['html'] == ''
+    assert not result['variants'][1]['validation']['valid']
+
+
+# --- Pipeline ---
+ITEMS = [
+    {'type': 'email', 'segment': 'a', 'html': '<p onclick="x()">A</p>'},
+    {'type': 'banner', 'segment': 'b', 'html': '<div>B</div>', 'css': 'div { color: red }'},
+]
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_html_pipeline(monkeypatch, workers):
+    monkeypatch.setattr(html_pipeline, 'HTML_PIPELINE_WORKERS', workers)
+    results = run_html_pipeline(ITEMS)
+    assert [r['html'] for r in results] == ['<p>A</p>', '<div style="color: red">B</div>']
+    assert all(r['validation']['valid'] for r in results)
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_run_html_pipeline_isolates_failing_items(monkeypatch, workers):
+    monkeypatch.setattr(html_pipeline, 'HTML_PIPELINE_WORKERS', workers)
+    # A non-string html value makes process_content_item raise
+    results = run_html_pipeline([{'segment': 'bad', 'html': 42}, ITEMS[0]])
+    assert results[0]['html'] == ''
+    assert not results[0]['validation']['valid']
+    assert results[0]['validation']['errors'][0].startswith('HTML pipeline failed')
+    assert results[1]['html'] == '<p>A</p>'
+
+
+def test_run_html_pipeline_empty():
+    assert run_html_pipeline([]) == []
+
+
+def test_run_html_pipeline_times_out_at_deadline(monkeypatch):
+    monkeypatch.setattr(html_pipeline, 'HTML_PIPELINE_WORKERS', 2)
+    monkeypatch.setattr(html_pipeline, 'HTML_PIPELINE_MIN_TIMEOUT_SECONDS', 0)
+    results = run_html_pipeline([{'segment': 'slow', 'html': '<p>' + 'x' * 100000 + '</p>'}], deadline_at=time.monotonic() - 1)
+    assert results[0]['html'] == ''
+    assert results[0]['validation']['errors'] == ['HTML pipeline failed: TimeoutError: no result before the deadline']
@@ -0,0 +1,205 @@
+import time
+
+import pytest
+
+import latency
+from latency import DeadlineExceeded, hedged_invoke, get_latency_stats, observed_p95
+from fake_model import FakeLatencyModel
+
+
+@pytest.fixture(autouse=True)
+def latency_settings():
+    previous = latency.configure(
+        hedge_min_samples=3, hedge_default_delay_seconds=0.05, hedge_min_delay_seconds=0.01,
+        hedging_enabled=True, llm_call_workers=8, max_hedges_in_flight=4,
+    )
+    latency.reset_latency_stats()
+    yield
+    latency.configure(**previous)
+    latency.reset_latency_stats()
+
+
+@pytest.fixture
+def models():
+    created = []
+
+    def make(*args, **kwargs):
+        model = FakeLatencyModel(*args, **kwargs)
+        created.append(model)
+        return model
+
+    yield make
+    for model in created:
+        model.release()
+
+
+def test_fast_call_does_not_hedge(models):
+    model = models([0.0])
+    assert hedged_invoke('fast', model, {}) == 'ok'
+    assert model.calls == 1
+    stats = get_latency_stats()['fast']
+    assert stats['calls'] == 1
+    assert stats['hedges_fired'] == 0
+
+
+def test_hedge_fires_and_wins(models):
+    model = models([5.0, 0.0], response=lambda call, inputs: f'call {call}')
+    start = time.monotonic()
+    assert hedged_invoke('slow', model, {}) == 'call 2'
+    assert time.monotonic() - start < 1.0
+    stats = get_latency_stats()['slow']
+    assert stats['hedges_fired'] == 1
+    assert stats['hedge_wins'] == 1
+    assert stats['hedge_rate'] == 1.0
+    assert stats['hedge_win_rate'] == 1.0
+
+
+def test_primary_wins_after_hedge_fires(models):
+    model = models([0.15, 5.0], response=lambda call, inputs: f'call {call}')
+    assert hedged_invoke('primary', model, {}) == 'call 1'
+    stats = get_latency_stats()['primary']
+    assert stats['hedges_fired'] == 1
+    assert stats['hedge_wins'] == 0
+
+
+def test_hedge_fires_at_observed_p95(models):
+    model = models([0.02, 0.02, 0.02, 5.0, 0.0])
+    for _ in range(3):
+        hedged_invoke('p95', model, {})
+    assert observed_p95('p95') < 0.05
+    latency.configure(hedge_default_delay_seconds=10)
+    start = time.monotonic()
+    hedged_invoke('p95', model, {})
+    assert time.monotonic() - start < 1.0
+    assert get_latency_stats()['p95']['hedge_wins'] == 1
+
+
+def test_losing_and_timed_out_calls_are_recorded(models):
+    model = models([0.3, 0.0])
+    hedged_invoke('losers', model, {})
+    # The slow primary lost to the hedge but is recorded once it finishes
+    time.sleep(0.4)
+    assert len(latency._latencies['losers']) == 2
+
+    hung = models([5.0])
+    latency.configure(hedging_enabled=False)
+    with pytest.raises(DeadlineExceeded):
+        hedged_invoke('hung', hung, {}, latency.new_deadline(0.1))
+    samples = list(latency._latencies['hung'])
+    assert len(samples) == 1
+    assert samples[0] >= 0.09
+
+
+def test_deadline_exceeded(models):
+    model = models([5.0])
+    with pytest.raises(DeadlineExceeded):
+        hedged_invoke('deadline', model, {}, latency.new_deadline(0.2))
+    stats = get_latency_stats()['deadline']
+    assert stats['deadline_exceeded'] == 1
+
+
+def test_expired_deadline_skips_the_call(models):
+    model = models([0.0])
+    with pytest.raises(DeadlineExceeded):
+        hedged_invoke('expired', model, {}, time.monotonic() - 1)
+    assert model.calls == 0
+
+
+def test_error_propagates(models):
+    model = models([(0.0, ValueError('bad request'))])
+    with pytest.raises(ValueError, match='bad request'):
+        hedged_invoke('error', model, {})
+    stats = get_latency_stats()['error']
+    assert stats['errors'] == 1
+    assert len(latency._latencies['error']) == 1
+
+
+def test_slow_failures_are_recorded(models):
+    model = models([(0.2, TimeoutError('upstream timeout'))])
+    latency.configure(hedging_enabled=False)
+    with pytest.raises(TimeoutError):
+        hedged_invoke('slow_error', model, {})
+    samples = list(latency._latencies['slow_error'])
+    assert len(samples) == 1
+    assert samples[0] >= 0.19
+
+
+def test_p95_ignores_single_outlier_in_twenty():
+    latency.configure(hedge_min_samples=20)
+    for seconds in [0.1] * 19 + [30.0]:
+        latency._record_latency(latency._Attempt('outlier', False), seconds)
+    assert observed_p95('outlier') == 0.1
+    assert latency.hedge_delay('outlier') == 0.1
+
+
+def test_p95_with_two_outliers_in_twenty():
+    latency.configure(hedge_min_samples=20)
+    for seconds in [0.1] * 18 + [30.0, 30.0]:
+        latency._record_latency(latency._Attempt('outliers', False), seconds)
+    assert observed_p95('outliers') == 30.0
+
+
+@pytest.mark.parametrize('seconds, valid', [
+    (30, True),
+    (0.5, True),
+    (600, True),
+    (0, False),
+    (-1, False),
+    (601, False),
+    (float('nan'), False),
+    (float('inf'), False),
+    (True, False),
+    ('30', False),
+])
+def test_valid_deadline_seconds(seconds, valid):
+    assert latency.valid_deadline_seconds(seconds) is valid
+
+
+def test_hedge_succeeds_when_primary_fails_late(models):
+    model = models([(0.2, RuntimeError('timeout upstream')), 0.0])
+    assert hedged_invoke('flaky', model, {}) == 'ok'
+    assert get_latency_stats()['flaky']['hedge_wins'] == 1
+
+
+def test_queued_requests_are_cancelled(models):
+    latency.configure(llm_call_workers=1, hedging_enabled=False)
+    blocker = models([5.0])
+    latency._get_executor().submit(blocker.invoke, {})
+    queued = models([0.0])
+    with pytest.raises(DeadlineExceeded):
+        hedged_invoke('queued', queued, {}, latency.new_deadline(0.1))
+    blocker.release()
+    time.sleep(0.1)
+    # The call never started, so it must not run after the request gave up
+    assert queued.calls == 0
+
+
+def test_saturated_pool_skips_hedging(models):
+    latency.configure(llm_call_workers=2, max_hedges_in_flight=1)
+    slow = models([0.3])
+    assert hedged_invoke('saturated', slow, {}) == 'ok'
+    stats = get_latency_stats()['saturated']
+    assert stats['hedges_fired'] == 1
+    # Fill both call threads, so the next slow call must not add a hedge
+    hung = models([5.0])
+    latency._submit('other', hung, {})
+    latency._submit('other', hung, {})
+    with pytest.raises(DeadlineExceeded):
+        hedged_invoke('saturated', models([5.0]), {}, latency.new_deadline(0.2))
+    assert get_latency_stats()['saturated']['hedges_skipped'] == 1
+
+
+def test_configure_overrides_stage_budgets():
+    previous = latency.configure(stage_budgets={'content': 0.5})
+    try:
+        deadline = latency.stage_deadline(None, 'content')
+        assert deadline - time.monotonic() <= 0.5
+        assert latency.stage_deadline(time.monotonic() + 0.1, 'content') - time.monotonic() <= 0.1
+    finally:
+        latency.configure(**previous)
+    assert latency.STAGE_BUDGETS['content'] == previous['stage_budgets']['content']
+
+
+def test_configure_rejects_unknown_setting():
+    with pytest.raises(ValueError):
+        latency.configure(hedge_everything=True)
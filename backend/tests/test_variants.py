@@ -0,0 +1,124 @@
+import time
+
+import pytest
+
+# app.py needs the ODBC driver at import time
+pytest.importorskip('pyodbc', exc_type=ImportError)
+
+import app
+import html_pipeline
+from app import parse_variants, _decode_json_objects, generate_content_variants
+
+
+# --- _decode_json_objects ---
+def test_decode_json_objects_skips_malformed_regions():
+    text = '{"subject": "a", "html": "<p>a</p>"} garbage {"subject": "b", "html": <broken} {"subject": "c", "html": "<p>c</p>"}'
+    assert _decode_json_objects(text) == [
+        {'subject': 'a', 'html': '<p>a</p>'},
+        {'subject': 'c', 'html': '<p>c</p>'},
+    ]
+
+
+def test_decode_json_objects_ignores_braces_in_prose():
+    assert _decode_json_objects('no objects { here') == []
+
+
+# --- parse_variants ---
+def test_parse_variants_from_structured_output():
+    payload = {'variants': [{'subject': 'a', 'html': '<p>a</p>'}, {'subject': 'b', 'html': '<p>b</p>'}]}
+    assert parse_variants(payload, 2) == (payload['variants'], [])
+
+
+def test_parse_variants_drops_malformed_variant():
+    payload = {'variants': [{'subject': 'a', 'html': '<p>a</p>'}, {'subject': 'b'}, 'not json', {'subject': 'c', 'html': '<p>c</p>'}]}
+    variants, errors = parse_variants(payload, 3)
+    assert [v['subject'] for v in variants] == ['a', 'c']
+    assert 'Variant 2 has no html' in errors
+    assert 'Variant 3 is not a JSON object' in errors
+    assert 'Expected 3 variants, got 2' in errors
+
+
+def test_parse_variants_recovers_from_invalid_json_text():
+    text = (
+        '```json\n{"variants": [{"subject": "a", "html": "<p style=\\"x\\">{a}</p>"}, '
+        '{"subject": "b", "html": "<p>b</p" BROKEN}, {"subject": "c", "html": "<p>c</p>"}]}\n```'
+    )
+    variants, errors = parse_variants(text, 3)
+    assert [v['subject'] for v in variants] == ['a', 'c']
+    assert errors[0].startswith('Response is not valid JSON')
+
+
+def test_parse_variants_accepts_json_text_and_bare_list():
+    assert parse_variants('{"variants": [{"subject": "a", "html": "<p>a</p>"}]}', 1) == ([{'subject': 'a', 'html': '<p>a</p>'}], [])
+    assert parse_variants([{'subject': 'a', 'html': '<p>a</p>'}], 1) == ([{'subject': 'a', 'html': '<p>a</p>'}], [])
+
+
+def test_parse_variants_fills_missing_subject_and_trims_extras():
+    variants, errors = parse_variants([{'html': '<p>a</p>'}, {'subject': 'b', 'html': '<p>b</p>'}, {'subject': 'c', 'html': '<p>c</p>'}], 2)
+    assert variants == [{'subject': 'Variant 1', 'html': '<p>a</p>'}, {'subject': 'b', 'html': '<p>b</p>'}]
+    assert errors == ['Variant 1 has no subject, using a placeholder']
+
+
+def test_parse_variants_rejects_non_list_payload():
+    assert parse_variants(42, 2) == ([], ['Expected a list of variants, got int'])
+
+
+# --- Variants mode ---
+STATE = {'intent_brief': 'Launch the new Surface Laptop', 'audience_segment': 'Students', 'num_variants': 3}
+
+
+def test_variants_without_llm(monkeypatch):
+    monkeypatch.setattr(app, 'variants_chain', None)
+    content = generate_content_variants('email', STATE)
+    assert len(content['variants']) == 3
+    assert content['html'] == content['variants'][0]['html']
+    assert content['variant_errors'] == []
+
+
+def test_variants_llm_error_propagates(monkeypatch):
+    class FailingChain:
+        def invoke(self, inputs):
+            raise RuntimeError('quota exceeded')
+
+    monkeypatch.setattr(app, 'variants_chain', FailingChain())
+    with pytest.raises(RuntimeError, match='quota exceeded'):
+        generate_content_variants('banner', STATE)
+
+
+def test_variants_deadline_uses_fallback_content(monkeypatch):
+    class HungChain:
+        def invoke(self, inputs):
+            time.sleep(5)
+
+    monkeypatch.setattr(app, 'variants_chain', HungChain())
+    content = generate_content_variants('banner', {**STATE, 'deadline_at': time.monotonic() - 1})
+    assert content['degraded']
+    assert content['css'] == ''
+    assert content['html'] == app.fallback_content('banner', STATE)['html']
+    assert content['variant_errors'] == ['No time left for variants']
+
+
+def test_content_stage_keeps_single_stub_without_llm(monkeypatch):
+    monkeypatch.setattr(app, 'llm', None)
+    monkeypatch.setattr(html_pipeline, 'HTML_PIPELINE_WORKERS', 0)
+    result = app.generate_content_for_segments({
+        'intent_brief': 'Launch the new Surface Laptop',
+        'audience_segments': ['Students', 'Gamers'],
+    })
+    assert [c['segment'] for c in result['content']] == ['Tech-savvy millennials']
+    assert result['content'][0]['html'] == '<p>Stub email</p>'
+
+
+def test_content_stage_supports_variants_without_llm(monkeypatch):
+    monkeypatch.setattr(app, 'llm', None)
+    monkeypatch.setattr(app, 'variants_chain', None)
+    monkeypatch.setattr(html_pipeline, 'HTML_PIPELINE_WORKERS', 0)
+    result = app.generate_content_for_segments({
+        'intent_brief': 'Launch the new Surface Laptop',
+        'audience_segments': ['Students', 'Gamers'],
+        'num_variants': 2,
+    })
+    assert [c['segment'] for c in result['content']] == ['Students', 'Gamers']
+    for content in result['content']:
+        assert len(content['variants']) == 2
+        assert all(v['validation']['valid'] for v in content['variants'])